@@ -25,13 +25,22 @@ from pysam import FUNMAP, FREVERSE, FSECONDARY, FSUPPLEMENTARY
 from pysam import AlignmentFile, AlignedSegment
 from struct import pack, unpack, calcsize
 from collections import defaultdict
+from functools import lru_cache
 from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
+import os
 from .utils import ensure_dir_exists
 
 MM_IDX_MAGIC = b"MMI\2"
 
 
 def check_minimap2_index(filename):
+    validate_minimap2_index(filename, os.path.getmtime(filename))
+
+
+# The modification time is a part of the cache key to notice a replaced index.
+@lru_cache(maxsize=4)
+def validate_minimap2_index(filename, mtime):
     with open(filename, 'rb') as idxf:
         magic = idxf.read(4)
         if magic != MM_IDX_MAGIC:
@@ -65,21 +74,37 @@ class BAMWriter:
         with self.lock:
             self.writer.write(segment)
 
+    def write_rows(self, rows):
+        # Keeps the records of a read together.
+        header = self.writer.header
+        segments = [AlignedSegment.fromstring('\t'.join(map(str, fields)), header)
+                    for fields in rows]
+        with self.lock:
+            for segment in segments:
+                self.writer.write(segment)
+
 
 class AlignmentWriter:
 
-    def __init__(self, indexfile, output, output_layout):
+    def __init__(self, indexfile, output, output_layout, num_threads=1):
         self.aligner = mappy.Aligner(indexfile)
         if not self.aligner:
             raise Exception('Could not open minimap2 index {}.'.format(indexfile))
         self.writers = self.open_writers(indexfile, output, output_layout)
 
+        # mappy releases the GIL while mapping, and a single index can be
+        # shared by the threads. Only the mapping runs in the pool, and the
+        # records are written in the order of the results by the caller.
+        self.executor = ThreadPoolExecutor(num_threads)
+
     def open_writers(self, indexfile, output, output_layout):
         indexed_sequences, index_options = list(self.get_indexed_sequence_list(indexfile))
         return {muxid: BAMWriter(output.format(name), indexed_sequences, index_options)
                 for muxid, name in output_layout.items()}
 
     def close(self):
+        if hasattr(self, 'executor'):
+            self.executor.shutdown()
         for muxid, writer in self.writers.items():
             writer.close()
         self.writers.clear()
@@ -144,40 +169,41 @@ class AlignmentWriter:
             yield (name, flag, h.ctg, h.r_st + 1, h.mapq, fullcigar, '*',
                    0, 0, seq_f, qual_f, 'NM:i:{}'.format(h.NM))
 
-    def map_and_write(self, streamid, name, seq, qual, adapter_length):
-        writer = self.writers[streamid]
-        mapped_seqname = None
+    def map_read(self, result):
+        seq, qual, adapter_length = result['sequence']
         if adapter_length > 0:
             seq = seq[:-adapter_length]
             qual = qual[:-adapter_length]
 
-        for row in self.map(name, seq, qual):
-            if mapped_seqname is None:
-                mapped_seqname = row[2]
-            writer.write(row)
-
-        if mapped_seqname is not None and not mapped_seqname.startswith('|'):
-            mapped_seqname = mapped_seqname.split('|')[0]
-        return mapped_seqname
+        return list(self.map(result['read_id'], seq, qual))
 
     def process(self, results):
         mapped_seqs = defaultdict(list)
         failed_counts = defaultdict(int)
         unmapped_counts = defaultdict(int)
 
+        mappable = [result for result in results
+                    if result.get('sequence') is not None and 'read_id' in result]
+        mapped_rows = self.executor.map(self.map_read, mappable)
+
         for result in results:
             barcode = result.get('barcode')
             streamid = result.get('label', 'fail'), barcode
 
             if result.get('sequence') is None or 'read_id' not in result:
                 failed_counts[barcode] += 1
-            else:
-                mapped = self.map_and_write(streamid, result['read_id'], *result['sequence'])
+                continue
 
-                if mapped == '*':
-                    unmapped_counts[barcode] += 1
-                else:
-                    mapped_seqs[barcode].append(mapped)
+            rows = next(mapped_rows)
+            self.writers[streamid].write_rows(rows)
+
+            mapped = rows[0][2]
+            if mapped == '*':
+                unmapped_counts[barcode] += 1
+            else:
+                if not mapped.startswith('|'):
+                    mapped = mapped.split('|')[0]
+                mapped_seqs[barcode].append(mapped)
 
         return {'mapped': mapped_seqs, 'failed': failed_counts, 'unmapped': unmapped_counts}
 
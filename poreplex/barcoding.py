@@ -21,7 +21,6 @@
 #
 
 from functools import partial
-from bisect import bisect_right
 import numpy as np
 import h5py
 import os
@@ -57,7 +56,7 @@ class BarcodeDemultiplexer:
             if np.any(calibtable['phred'][:] != np.arange(len(calibtable))):
                 raise RuntimeError('Calibration table in {} is not continuous.'.format(
                                         model_file))
-            self.calibration_table = list(calibtable['pred_score'])
+            self.calibration_table = np.asarray(calibtable['pred_score'])
 
             cost_mtx = modf['poreplex_params/loss_weights'][:]
             keras.utils.get_custom_objects().update({
@@ -69,10 +68,10 @@ class BarcodeDemultiplexer:
 
         return keras.models.load_model(model_file)
 
-    def lookup_calibrated_phred_score(self, score):
-        if score <= 0.:
-            return 0
-        return bisect_right(self.calibration_table, score)
+    def lookup_calibrated_phred_scores(self, scores):
+        calibrated = np.searchsorted(self.calibration_table, scores, side='right')
+        calibrated[scores <= 0.] = 0
+        return calibrated
 
     @staticmethod
     def normalize_signal(sig):
@@ -108,14 +107,14 @@ class BarcodeDemultiplexer:
             predlabels = np.argmax(predweights, axis=1) - self.config['number_of_decoy_labels']
             predscores = np.amax(predweights, axis=1)
 
-            for npread, bcid, score in zip(self.signal_assoc_read, predlabels, predscores):
-                if bcid >= 0 and score >= self.score_threshold:
-                    effective_bcid = int(bcid)
-                else:
-                    effective_bcid = None
+            # Resolve the whole batch in numpy, then hand plain ints to the reads.
+            accepted = (predlabels >= 0) & (predscores >= self.score_threshold)
+            calib_scores = self.lookup_calibrated_phred_scores(predscores)
 
-                calib_score = self.lookup_calibrated_phred_score(score)
-                npread.set_barcode(effective_bcid, int(bcid), calib_score)
+            for npread, bcid, ok, calib_score in zip(
+                    self.signal_assoc_read, predlabels.tolist(), accepted.tolist(),
+                    calib_scores.tolist()):
+                npread.set_barcode(bcid if ok else None, bcid, calib_score)
 
 
 if __name__ == '__main__':
@@ -24,14 +24,18 @@ import argparse
 import sys
 import os
 import time
-import yaml
 import shutil
+import pickle
+import importlib.util
 import subprocess as sp
 import logging
-from functools import partial
-from . import *
-from .pipeline import ProcessingSession
-from .alignment_writer import check_minimap2_index
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from hashlib import sha1
+from . import (
+    __version__, OUTPUT_NAME_PASSED, OUTPUT_NAME_FAILED, OUTPUT_NAME_ARTIFACT,
+    OUTPUT_NAME_BARCODES, OUTPUT_NAME_UNDETERMINED, OUTPUT_NAME_BARCODING_OFF)
 from .utils import *
 
 VERSION_STRING = """\
@@ -40,6 +44,39 @@ Written by Hyeshik Chang <hyeshik@snu.ac.kr>.
 
 Copyright (c) 2018-2019 Institute for Basic Science""".format(version=__version__)
 
+PACKAGE_DIR = os.path.dirname(__file__)
+PRESETS_DIR = os.path.join(PACKAGE_DIR, 'presets')
+KMER_MODELS_DIR = os.path.join(PACKAGE_DIR, 'kmer_models')
+
+CONDITIONAL_SUBDIRS = (
+    ('fastq_output', 'fastq'),
+    ('fast5_output', 'fast5'),
+    ('nanopolish_output', 'nanopolish'),
+    ('minimap2_index', 'bam'),
+    ('dump_adapter_signals', 'adapter-dumps'),
+    ('dump_basecalls', 'events'),
+)
+
+# (config key to enable the line, or None, line template)
+SETTINGS_SUMMARY_LINES = (
+    (None, "== Analysis settings ======================================"),
+    (None, " * Input:{sep}{inputdir}{sep}{live_tag}"),
+    (None, " * Output:{sep}{outputdir}"),
+    (None, " * Processes:{sep}{parallel}"),
+    (None, " * Presets:{sep}{preset_name}"),
+    (None, " * Basecall on-the-fly:\t{sep}{basecall}"),
+    (None, " * Trim 3' adapter:\t{sep}{trim_adapter}"),
+    (None, " * Filter concatenated read:{sep}{filter_unsplit_reads}"),
+    (None, " * Separate by barcode:\t{sep}{barcoding}"),
+    (None, " * Real-time alignment:\t{sep}{minimap2_index}"),
+    (None, " * FASTQ in output:\t{sep}{fastq_output}"),
+    (None, " * FAST5 in output:\t{sep}{fast5_output}"),
+    (None, " * Basecall table in output:{sep}{dump_basecalls}"),
+    ('dump_adapter_signals', " * Dump adapter signals for training:{sep}Yes"),
+    (None, "==========================================================="),
+    (None, ""),
+)
+
 def show_banner():
     print("""
 \x1b[1mPoreplex\x1b[0m version {version} by Hyeshik Chang <hyeshik@snu.ac.kr>
@@ -57,81 +94,165 @@ class VersionAction(argparse.Action):
         print(VERSION_STRING)
         parser.exit()
 
+def get_user_cache_path(name):
+    cachedir = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return os.path.join(cachedir, 'poreplex', name)
+
+def get_config_cache_paths(config_path):
+    # Only the bundled presets get a sidecar next to them. Caches of other
+    # configurations are kept in the per-user cache directory, which is also
+    # the fallback for read-only installations.
+    realpath = os.path.realpath(config_path)
+    if os.path.dirname(realpath) == os.path.realpath(PRESETS_DIR):
+        yield realpath + '.pkl'
+
+    pathhash = sha1(realpath.encode()).hexdigest()[:16]
+    yield get_user_cache_path('config-{}.pkl'.format(pathhash))
+
+def load_yaml_cached(config_path):
+    # The cache is valid only for the exact same version of the source.
+    st = os.stat(config_path)
+    src_stamp = st.st_mtime_ns, st.st_size
+    cache_paths = list(get_config_cache_paths(config_path))
+
+    for cache_path in cache_paths:
+        try:
+            with open(cache_path, 'rb') as f:
+                stamp, config = pickle.load(f)
+            if stamp == src_stamp:
+                return config
+        except (OSError, EOFError, ValueError, pickle.UnpicklingError):
+            pass
+
+    import yaml
+    try:
+        from yaml import CSafeLoader as YamlLoader
+    except ImportError:
+        from yaml import SafeLoader as YamlLoader
+
+    with open(config_path) as f:
+        config = yaml.load(f, Loader=YamlLoader)
+
+    for cache_path in cache_paths:
+        try:
+            ensure_dir_exists(cache_path)
+            with open(cache_path, 'wb') as f:
+                pickle.dump((src_stamp, config), f, protocol=pickle.HIGHEST_PROTOCOL)
+        except OSError:
+            continue
+        break
+
+    return config
+
+@lru_cache(maxsize=16)
+def resolve_config_path(name):
+    if not name:
+        return os.path.join(PRESETS_DIR, 'rna-r941.cfg')
+    elif os.path.isfile(name):
+        return name
+    elif os.path.isfile(os.path.join(PRESETS_DIR, name + '.cfg')):
+        return os.path.join(PRESETS_DIR, name + '.cfg')
+
 def load_config(args):
-    presets_dir = os.path.join(os.path.dirname(__file__), 'presets')
-    if not args.config:
-        config_path = os.path.join(presets_dir, 'rna-r941.cfg')
-    elif os.path.isfile(args.config):
-        config_path = args.config
-    elif os.path.isfile(os.path.join(presets_dir, args.config + '.cfg')):
-        config_path = os.path.join(presets_dir, args.config + '.cfg')
-    else:
+    config_path = resolve_config_path(args.config or '')
+    if config_path is None:
         errx('ERROR: Cannot find a configuration in {}.'.format(args.config))
 
-    config = yaml.load(open(config_path), Loader=yaml.FullLoader)
-    kmer_models_dir = os.path.join(os.path.dirname(__file__), 'kmer_models')
+    config = load_yaml_cached(config_path)
     if not os.path.isabs(config['kmer_model']):
-        config['kmer_model'] = os.path.join(kmer_models_dir, config['kmer_model'])
+        config['kmer_model'] = os.path.join(KMER_MODELS_DIR, config['kmer_model'])
 
     return config
 
+class BufferedFileHandler(logging.FileHandler):
+
+    # Leaves the records in the buffer of the file instead of a flush for
+    # every line. Errors are written out immediately, and the rest
+    # periodically by the processing session and at exit by logging.shutdown().
+    def emit(self, record):
+        try:
+            self.stream.write(self.format(record) + self.terminator)
+            if record.levelno >= logging.ERROR:
+                self.flush()
+        except RecursionError:
+            raise
+        except Exception:
+            self.handleError(record)
+
 def init_logging(config):
     logfile = os.path.join(config['outputdir'], 'poreplex.log')
     logger = logging.getLogger('poreplex')
     logger.propagate = False
-    handler = logging.FileHandler(logfile, 'w')
+    handler = BufferedFileHandler(logfile, 'w')
+    handler.setFormatter(logging.Formatter('%(asctime)-15s %(message)s'))
 
     logger.setLevel(logging.INFO)
-    handler.setFormatter(logging.Formatter('%(asctime)-15s %(message)s'))
     logger.addHandler(handler)
 
     return logger
 
+def remove_dir_entry(ent):
+    if ent.is_dir(follow_symlinks=False):
+        shutil.rmtree(ent.path)
+    else:
+        os.unlink(ent.path)
+
+def clear_directory(dirpath):
+    # Move the previous contents into a hidden subdirectory and delete them in
+    # background, so that the new run does not wait for the removal of large
+    # outputs. The directory itself stays with its mode, owner and ACLs.
+    with os.scandir(dirpath) as it:
+        entries = list(it)
+
+    leftovers = entries
+    stale = os.path.join(dirpath, '.stale.{}'.format(os.getpid()))
+    try:
+        os.mkdir(stale)
+    except OSError:
+        pass
+    else:
+        leftovers = []
+        for ent in entries:
+            try:
+                os.rename(ent.path, os.path.join(stale, ent.name))
+            except OSError: # e.g. EXDEV for a mount point
+                leftovers.append(ent)
+
+        threading.Thread(target=shutil.rmtree, args=(stale,),
+                         kwargs={'ignore_errors': True}).start()
+
+    # Removals are bound by filesystem latency, not the GIL.
+    if leftovers:
+        with ThreadPoolExecutor(max_workers=min(8, len(leftovers))) as executor:
+            list(executor.map(remove_dir_entry, leftovers))
+
 def create_output_directories(config):
     outputdir = config['outputdir']
-    existing = os.listdir(outputdir)
-    if existing:
-        while config['interactive']:
+    with os.scandir(outputdir) as it:
+        is_empty = next(it, None) is None
+    if not is_empty:
+        if config['interactive']:
             try:
                 answer = input('Output directory {} is not empty. Clear it? (y/N) '
                                 .format(outputdir))
             except KeyboardInterrupt:
                 raise SystemExit
-            answer = answer.lower()[:1]
-            if answer in ('', 'n'):
+            except EOFError:
+                answer = ''
+            if not answer.strip().lower().startswith('y'):
                 sys.exit(1)
-            elif answer == 'y':
-                print()
-                break
-
-        for ent in existing:
-            fpath = os.path.join(outputdir, ent)
-            if os.path.isdir(fpath):
-                shutil.rmtree(fpath)
-            else:
-                os.unlink(fpath)
-
-    subdirs = []
-    conditional_subdirs = [
-        ('fastq_output', 'fastq'),
-        ('fast5_output', 'fast5'),
-        ('nanopolish_output', 'nanopolish'),
-        ('minimap2_index', 'bam'),
-        ('dump_adapter_signals', 'adapter-dumps'),
-        ('dump_basecalls', 'events'),
-    ]
-    for condition, subdir in conditional_subdirs:
-        if config[condition]:
-            subdirs.append(subdir)
+            print()
+
+        clear_directory(outputdir)
+
+    subdirs = [subdir for condition, subdir in CONDITIONAL_SUBDIRS
+               if config[condition]]
 
     for subdir in subdirs:
-        fullpath = os.path.join(outputdir, subdir)
-        if not os.path.isdir(fullpath):
-            os.makedirs(fullpath)
+        os.makedirs(os.path.join(outputdir, subdir), exist_ok=True)
 
-    if not os.path.isdir(config['tmpdir']):
-        os.makedirs(config['tmpdir'])
-        config['cleanup_tmpdir'] = True
+    config['cleanup_tmpdir'] = not os.path.isdir(config['tmpdir'])
+    os.makedirs(config['tmpdir'], exist_ok=True)
 
 
 def setup_output_name_mapping(config):
@@ -159,41 +280,41 @@ def setup_output_name_mapping(config):
     return label_names, barcode_names, layout_maps
 
 
-def show_configuration(config, output):
-    if hasattr(output, 'write'): # file-like object
-        _ = partial(print, sep='\t', file=output)
-    else: # logger object
-        _ = lambda *args: output.info(' '.join(map(str, args)))
-
+def show_configuration(config, outputs):
     bool2yn = lambda b: 'Yes' if b else 'No'
 
-    _("== Analysis settings ======================================")
-    _(" * Input:", config['inputdir'],
-      '(live, {} sec delay)'.format(config['analysis_start_delay'])
-      if config['live'] else '')
-    _(" * Output:", config['outputdir'])
-    _(" * Processes:", config['parallel'])
-    _(" * Presets:", config['preset_name'])
-    _(" * Basecall on-the-fly:\t",
-        'Yes (albacore {})'.format(config['albacore_version'])
-        if config['albacore_onthefly'] else 'No (use previous analyses)')
-    _(" * Trim 3' adapter:\t", bool2yn(config['trim_adapter']))
-    _(" * Filter concatenated read:", bool2yn(config['filter_unsplit_reads']))
-    _(" * Separate by barcode:\t", bool2yn(config['barcoding']))
-    _(" * Real-time alignment:\t", bool2yn(config['minimap2_index']))
-    _(" * FASTQ in output:\t", bool2yn(config['fastq_output']))
-    _(" * FAST5 in output:\t", bool2yn(config['fast5_output']))
-    _(" * Basecall table in output:", bool2yn(config['dump_basecalls']))
-
-    if config['dump_adapter_signals']:
-        _(" * Dump adapter signals for training:", "Yes")
-    _("===========================================================")
-    _("")
+    template = '\n'.join(line for condition, line in SETTINGS_SUMMARY_LINES
+                         if condition is None or config[condition])
+    ctx = {
+        'inputdir': config['inputdir'],
+        'live_tag': '(live, {} sec delay)'.format(config['analysis_start_delay'])
+                    if config['live'] else '',
+        'outputdir': config['outputdir'],
+        'parallel': config['parallel'],
+        'preset_name': config['preset_name'],
+        'basecall': 'Yes (albacore {})'.format(config['albacore_version'])
+                    if config['albacore_onthefly'] else 'No (use previous analyses)',
+        'trim_adapter': bool2yn(config['trim_adapter']),
+        'filter_unsplit_reads': bool2yn(config['filter_unsplit_reads']),
+        'barcoding': bool2yn(config['barcoding']),
+        'minimap2_index': bool2yn(config['minimap2_index']),
+        'fastq_output': bool2yn(config['fastq_output']),
+        'fast5_output': bool2yn(config['fast5_output']),
+        'dump_basecalls': bool2yn(config['dump_basecalls']),
+    }
+
+    for output in outputs:
+        if hasattr(output, 'write'): # file-like object
+            output.write(template.format(sep='\t', **ctx) + '\n')
+        else: # logger object
+            for line in template.format(sep=' ', **ctx).split('\n'):
+                output.info(line)
 
 def test_prerequisite_compatibility(config):
-    from distutils.version import LooseVersion
     from pomegranate import __version__ as pomegranate_version
-    if LooseVersion(pomegranate_version) <= LooseVersion('0.9.0'):
+    version_parts = tuple(int(x) for x in pomegranate_version.split('.')[:3]
+                          if x.isdigit())
+    if version_parts <= (0, 9, 0):
         errprint('''
 WARNING: You have pomegranate {} installed, which has a known
 problem that the memory consumption indefinitely grow. The processing
@@ -204,17 +325,58 @@ with the fix:
   pip install cython
   pip install git+https://github.com/jmschrei/pomegranate.git\n'''.format(pomegranate_version))
 
+def prepare_albacore(configpath, flowcell, kit):
+    # Check the availability and version compatibility in a subprocess to
+    # avoid potential conflicts between duplicated resources in the C++
+    # library memory space when the workers are forked into multiple processes.
+    return sp.check_output([sys.executable, '-m',
+        'poreplex.basecall_albacore', configpath, flowcell, kit]).decode().strip()
+
+def prepare_albacore_cached(configpath, flowcell, kit):
+    # Locate albacore without importing it for the same reason as above.
+    try:
+        spec = importlib.util.find_spec('albacore')
+    except (ImportError, ValueError):
+        spec = None
+    if spec is None or spec.origin is None:
+        return prepare_albacore(configpath, flowcell, kit)
+
+    # The probe result and the generated configuration are reused until
+    # albacore is reinstalled.
+    pkgdir = os.path.dirname(spec.origin)
+    cachekey = sha1('|'.join([flowcell, kit, pkgdir]).encode()).hexdigest()[:16]
+    cache_path = get_user_cache_path('albacore-{}.txt'.format(cachekey))
+    try:
+        if os.path.getmtime(cache_path) >= os.path.getmtime(pkgdir):
+            with open(cache_path) as f:
+                version = f.readline().strip()
+                albacore_config = f.read()
+            with open(configpath, 'w') as f:
+                f.write(albacore_config)
+            return 'okay ' + version
+    except OSError:
+        pass
+
+    result = prepare_albacore(configpath, flowcell, kit)
+    if result.startswith('okay'):
+        try:
+            with open(configpath) as f:
+                albacore_config = f.read()
+            ensure_dir_exists(cache_path)
+            with open(cache_path, 'w') as f:
+                f.write(result.split()[1] + '\n' + albacore_config)
+        except OSError:
+            pass
+
+    return result
+
 def test_optional_features(config):
     if config['albacore_onthefly']:
         config['albacore_configuration'] = os.path.join(
             config['outputdir'], 'albacore-configuration.cfg')
 
-        # Check the availability and version compatibility in a subprocess to
-        # avoid potential conflicts between duplicated resources in the C++
-        # library memory space when the workers are forked into multiple processes.
-        result = sp.check_output([sys.executable, '-m',
-            'poreplex.basecall_albacore', config['albacore_configuration'],
-            config['flowcell'], config['kit']]).decode().strip()
+        result = prepare_albacore_cached(config['albacore_configuration'],
+                                         config['flowcell'], config['kit'])
         if result.startswith('okay'):
             config['albacore_version'] = result.split()[1]
         else:
@@ -243,6 +405,7 @@ def test_inputs_and_outputs(config):
             errx('ERROR: Failed to create the output directory {}.'.format(config['outputdir']))
 
     if config['minimap2_index']:
+        from .alignment_writer import check_minimap2_index
         try:
             check_minimap2_index(config['minimap2_index'])
         except:
@@ -265,35 +428,40 @@ def main(args):
         show_banner()
 
     config = load_config(args)
-    config['quiet'] = args.quiet
-    config['interactive'] = not args.yes
-    config['parallel'] = args.parallel
-    config['inputdir'] = args.input
-    config['outputdir'] = args.output
-    config['live'] = args.live
-    config['analysis_start_delay'] = args.live_delay if args.live else 0
-    config['dashboard'] = args.dashboard
-    config['contig_aliases'] = args.contig_aliases
-    config['tmpdir'] = args.tmpdir if args.tmpdir else os.path.join(args.output, 'tmp')
-    config['cleanup_tmpdir'] = False # will be changed during creation of output dirs
-    config['barcoding'] = args.barcoding
-    config['barcoding_quality_filter'] = args.barcoding_quality_filter
-    config['measure_polya'] = args.polya
-    config['filter_unsplit_reads'] = args.filter_chimera
-    config['batch_chunk_size'] = args.batch_size
-    config['albacore_onthefly'] = args.basecall
-    config['dump_adapter_signals'] = args.dump_adapter_signals
-    config['dump_basecalls'] = args.dump_basecalled_events
-    config['fastq_output'] = args.align is None or args.fastq
-    config['fast5_output'] = args.fast5 or args.nanopolish
-    config['fast5_batch_size'] = args.fast5_batch_size
-    config['nanopolish_output'] = args.nanopolish
-    config['trim_adapter'] = args.trim_adapter
-    config['minimum_sequence_length'] = args.minimum_length
-    config['minimap2_index'] = args.align if args.align else None
+    opts = vars(args)
+    config.update({
+        'quiet': opts['quiet'],
+        'interactive': not opts['yes'],
+        'parallel': opts['parallel'],
+        'inputdir': opts['input'],
+        'outputdir': opts['output'],
+        'live': opts['live'],
+        'analysis_start_delay': opts['live_delay'] if opts['live'] else 0,
+        'dashboard': opts['dashboard'],
+        'contig_aliases': opts['contig_aliases'],
+        'tmpdir': opts['tmpdir'] or os.path.join(opts['output'], 'tmp'),
+        'cleanup_tmpdir': False, # will be changed during creation of output dirs
+        'barcoding': opts['barcoding'],
+        'barcoding_quality_filter': opts['barcoding_quality_filter'],
+        'measure_polya': opts['polya'],
+        'filter_unsplit_reads': opts['filter_chimera'],
+        'batch_chunk_size': opts['batch_size'], # None for automatic tuning
+        'max_queue_time': (opts['max_queue_time'] if opts['max_queue_time'] is not None
+                           else max(20, opts['live_delay'])),
+        'albacore_onthefly': opts['basecall'],
+        'dump_adapter_signals': opts['dump_adapter_signals'],
+        'dump_basecalls': opts['dump_basecalled_events'],
+        'fastq_output': opts['align'] is None or opts['fastq'],
+        'fast5_output': opts['fast5'] or opts['nanopolish'],
+        'fast5_batch_size': opts['fast5_batch_size'],
+        'nanopolish_output': opts['nanopolish'],
+        'trim_adapter': opts['trim_adapter'],
+        'minimum_sequence_length': opts['minimum_length'],
+        'minimap2_index': opts['align'] or None,
+        'nobasecall_stop_trigger': 1000,
+    })
     config['label_names'], config['barcode_names'], config['output_layout'] = \
         setup_output_name_mapping(config)
-    config['nobasecall_stop_trigger'] = 1000
 
     fix_options(config)
 
@@ -307,10 +475,11 @@ def main(args):
     logger.info('Starting poreplex version {}'.format(__version__))
     logger.info('Command line: ' + ' '.join(sys.argv))
 
-    show_configuration(config, output=logger)
-    if not config['quiet']:
-        show_configuration(config, output=sys.stdout)
+    # The log file already keeps the settings for the non-interactive runs.
+    show_configuration(config, outputs=[logger] +
+        ([sys.stdout] if not config['quiet'] and sys.stdout.isatty() else []))
 
+    from .pipeline import ProcessingSession
     procresult = ProcessingSession.run(config, logger)
 
     if procresult is not None:
@@ -368,6 +537,9 @@ def __main__():
     group.add_argument('--live-delay', default=60, type=int, metavar='SECONDS',
                        help='time to delay the start of analysis in live mode '
                             '(default: 60)')
+    group.add_argument('--max-queue-time', default=None, type=int, metavar='SECONDS',
+                       help='time to wait before processing an incomplete batch in '
+                            'live mode (default: the live delay, at least 20)')
 
     group = parser.add_argument_group('Output Options')
     group.add_argument('--fastq', default=False, action='store_true',
@@ -399,8 +571,9 @@ def __main__():
                        help='number of worker processes (default: 1)')
     group.add_argument('--tmpdir', default='', type=str, metavar='DIR',
                        help='temporary directory for intermediate data')
-    group.add_argument('--batch-size', default=128, type=int, metavar='SIZE',
-                       help='number of files in a single batch (default: 128)')
+    group.add_argument('--batch-size', default=None, type=int, metavar='SIZE',
+                       help='number of reads in a single batch (default: adjusted '
+                            'automatically)')
     group.add_argument('--version', action=VersionAction,
                        help="show program's version number and exit")
     group.add_argument('-h', '--help', action='help',
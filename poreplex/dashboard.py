@@ -386,15 +386,15 @@ class DashboardView:
             unhandled_input=self.exit_on_q
         )
 
-        self.start_update_hooks(loop)
+        self.start_update_hooks()
 
         self.urwid_loop.start()
         #uaioloop.run()
 
-    def start_update_hooks(self, loop):
-        loop.create_task(self.update_elapsed_time())
-        loop.create_task(self.update_read_count_stats())
-        loop.create_task(self.update_overview_status())
+    def start_update_hooks(self):
+        self.session.spawn(self.update_elapsed_time())
+        self.session.spawn(self.update_read_count_stats())
+        self.session.spawn(self.update_overview_status())
 
     async def update_elapsed_time(self):
         label = self.label_overview_elapsed_time
@@ -22,13 +22,15 @@
 
 import asyncio
 import traceback
+import time
 import signal
 import math
 import sys
 import os
+import multiprocessing as mp
 from io import StringIO
 from itertools import cycle
-from collections import defaultdict
+from collections import defaultdict, deque
 from concurrent.futures import (
     ProcessPoolExecutor, CancelledError, ThreadPoolExecutor)
 from concurrent.futures.process import BrokenProcessPool
@@ -37,38 +39,67 @@ from .io import (
     FASTQWriter, SequencingSummaryWriter, FinalSummaryTracker,
     NanopolishReadDBWriter, create_adapter_dumps_inventory,
     create_events_inventory, FAST5Writer)
-from .signal_analyzer import process_batch
+from .signal_analyzer import init_worker, process_batch
+from .worker_persistence import WorkerPersistenceStorage
 from .alignment_writer import AlignmentWriter
 from .utils import *
 from .fast5_file import get_read_ids
 
 FAST5_SUFFIX = '.fast5'
+SCAN_PARALLELISM = 16
+PROGRESS_REFRESH_TIMEOUT = 1.0
+LOG_FLUSH_INTERVAL = 10.0
+PENDING_BATCHES_PER_WORKER = 2
+
+# Automatic batch size tuning from the observed processing time per read
+BATCH_SIZE_INITIAL = 128
+BATCH_SIZE_RANGE = 4, 256
+BATCH_TARGET_TIME = 0.75
+BATCH_COST_SMOOTHING = 0.3
+BATCH_FIXED_COST_RATIO = 4 # variable cost per fixed cost of a batch, at least
+BATCH_SIZE_SPREAD_MIN = 0.1 # relative spread of sizes to separate the costs
+
+# The summaries are written for the results collected during this period.
+SUMMARY_CHUNK_SIZE = 1024
+SUMMARY_COLLECT_TIME = 0.5
+
+
+def scan_dir_worker(topdir, dirname, suffix=FAST5_SUFFIX):
+    # The directory entries from scandir save a stat call for each file.
+    # The relative paths are built by concatenation with the directory prefix.
+    dirs, files = [], []
+    prefix = dirname + '/' if dirname else ''
+    with os.scandir(os.path.join(topdir, dirname)) as it:
+        for entry in it:
+            name = entry.name
+            if name.startswith('.'):
+                continue
 
+            if entry.is_dir():
+                dirs.append(prefix + name)
+            elif name.lower().endswith(suffix):
+                files.append(prefix + name)
 
-def force_terminate_executor(executor):
-    executor._call_queue.empty()
+    return dirs, files
 
-    if executor._processes:
-        alive_pids = set(
-            pid for pid, proc in executor._processes.items()
-            if proc.is_alive())
-        for pid in alive_pids:
-            os.kill(pid, signal.SIGKILL)
 
+# This function must be picklable.
+def run_timed(func, *args):
+    # Measures the time spent in the worker, excluding the time in the queue.
+    started = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - started
 
-def scan_dir_recursive_worker(dirname, suffix=FAST5_SUFFIX):
-    files, dirs = [], []
-    for entryname in os.listdir(dirname):
-        if entryname.startswith('.'):
-            continue
 
-        fullpath = os.path.join(dirname, entryname)
-        if os.path.isdir(fullpath):
-            dirs.append(entryname)
-        elif entryname.lower().endswith(suffix):
-            files.append(entryname)
-
-    return dirs, files
+def collect_inotify_events(evgen):
+    # The generator yields None at the end of every polling cycle. Take all
+    # events from a cycle at once to save a thread hop for each of them.
+    events = []
+    for event in evgen:
+        if event is None:
+            break
+        events.append(event)
+    return events
 
 
 def show_memory_usage():
@@ -85,17 +116,29 @@ class ProcessingSession:
         self.reads_queued = self.reads_found = 0
         self.reads_processed = 0
         self.next_batch_id = 0
-        self.reads_done = set()
+        # Maps reads to the batch that is processing or has processed them
+        self.reads_submitted = {}
         self.active_batches = 0
         self.error_status_counts = defaultdict(int)
-        self.jobstack = []
+        self.jobstack = deque()
+        # Number of reads at the front of the stack to go in partial batches
+        self.reads_to_flush = 0
+        self.batch_size = config['batch_chunk_size'] or BATCH_SIZE_INITIAL
+        self.batch_stats = self.batch_costs = None
+        self.tasks = set()
 
         self.config = config
         self.logger = logger
 
-        self.executor_compute = ProcessPoolExecutor(config['parallel'])
+        # The models are loaded here once and shared with the forked workers.
+        # The configuration is sent to the workers only once at their start.
+        WorkerPersistenceStorage(config).preload_shared_objects()
+        self.executor_compute = ProcessPoolExecutor(
+            config['parallel'], mp_context=mp.get_context('fork'),
+            initializer=init_worker, initargs=(config,))
         self.executor_io = ThreadPoolExecutor(2)
         self.executor_mon = ThreadPoolExecutor(2)
+        self.executor_scan = ThreadPoolExecutor(SCAN_PARALLELISM)
 
         self.loop = self.fastq_writer = self.fast5_writer = \
             self.alignment_writer = self.npreaddb_writer = None
@@ -103,9 +146,17 @@ class ProcessingSession:
 
     def __enter__(self):
         self.loop = asyncio.get_event_loop()
+        self.progress_updated = asyncio.Event()
+        self.summary_queue = asyncio.Queue()
+        self.jobstack_updated = asyncio.Event()
+        # Bounds the batches in flight so that a fast scanner can't flood the
+        # process pool with pickled jobs and results.
+        self.batch_slots = asyncio.Semaphore(
+            self.config['parallel'] * PENDING_BATCHES_PER_WORKER)
         self.executor_compute.__enter__()
         self.executor_io.__enter__()
         self.executor_mon.__enter__()
+        self.executor_scan.__enter__()
 
         for signame in 'SIGINT SIGTERM'.split():
             self.loop.add_signal_handler(getattr(signal, signame),
@@ -127,12 +178,17 @@ class ProcessingSession:
         self.finalsummary_tracker = FinalSummaryTracker(
             self.config['label_names'], self.config['barcode_names'])
 
+        self.adapter_dump_prefix = os.path.join(self.config['outputdir'], 'adapter-dumps')
+        self.events_prefix = os.path.join(self.config['outputdir'], 'events')
+
         if self.config['minimap2_index']:
             self.show_message('==> Loading a minimap2 index file')
+            # One mapping thread per compute worker. The I/O threads share the
+            # pool, so the mapping does not take more CPUs than the analysis.
             self.alignment_writer = AlignmentWriter(
                 self.config['minimap2_index'],
                 os.path.join(self.config['outputdir'], 'bam', '{}.bam'),
-                self.config['output_layout'])
+                self.config['output_layout'], self.config['parallel'])
 
         return self
 
@@ -157,6 +213,7 @@ class ProcessingSession:
             self.alignment_writer.close()
             self.alignment_writer = None
 
+        self.executor_scan.__exit__(*args)
         self.executor_mon.__exit__(*args)
         self.executor_io.__exit__(*args)
         self.executor_compute.__exit__(*args)
@@ -176,11 +233,18 @@ class ProcessingSession:
             if signalname in ['SIGTERM', 'SIGINT']:
                 errprint("\nTermination in process. Please wait for a moment.")
             self.running = False
-        for task in asyncio.Task.all_tasks():
+        for task in list(self.tasks):
             task.cancel()
 
         self.loop.stop()
 
+    def spawn(self, coro):
+        # Keep track of the tasks to cancel them without scanning the loop
+        task = self.loop.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
     def run_in_executor_compute(self, *args):
         return self.loop.run_in_executor(self.executor_compute, *args)
 
@@ -190,64 +254,41 @@ class ProcessingSession:
     def run_in_executor_mon(self, *args):
         return self.loop.run_in_executor(self.executor_mon, *args)
 
-    async def run_process_batch(self, batchid, files):
-        # Wait until the input files become ready if needed
-        if self.config['analysis_start_delay'] > 0:
-            try:
-                await asyncio.sleep(self.config['analysis_start_delay'])
-            except CancelledError:
-                return
+    def run_in_executor_scan(self, *args):
+        return self.loop.run_in_executor(self.executor_scan, *args)
 
+    async def run_process_batch(self, batchid, files):
         self.active_batches += 1
         try:
-
-            results = await self.run_in_executor_compute(
-                process_batch, batchid, files, self.config)
-
-            if len(results) > 0 and results[0] == -1: # Unhandled exception occurred
-                error_message = results[1]
-                self.logger.error(error_message)
-                for line in results[2].splitlines():
-                    self.logger.error(line)
-                self.errx("ERROR: " + error_message)
-                return
+            results, elapsed = await self.run_in_executor_compute(
+                run_timed, process_batch, batchid, files)
+            self.tune_batch_size(len(files), elapsed)
 
             # Remove duplicated results that could be fed multiple times in live monitoring
             nd_results = []
+            reads_submitted = self.reads_submitted
             for result in results:
-                readpath = result['filename'], result['read_id']
-                if readpath not in self.reads_done:
-                    if result['status'] == 'okay':
-                        self.reads_done.add(readpath)
-                    elif 'error_message' in result:
-                        self.logger.error(result['error_message'])
+                readpath = result['filename'], result.get('read_id')
+                if reads_submitted.get(readpath, batchid) == batchid:
+                    if result['status'] != 'okay':
+                        # Release the read to allow retrying on later changes
+                        reads_submitted.pop(readpath, None)
+                        if 'error_message' in result:
+                            self.logger.error(result['error_message'])
                     nd_results.append(result)
                 else: # Cancel the duplicated result
                     self.reads_queued -= 1
                     self.reads_found -= 1
+                    self.progress_updated.set()
 
                 self.error_status_counts[result['status']] += 1
 
             if nd_results:
-                if self.config['fastq_output']:
-                    await self.run_in_executor_io(self.fastq_writer.write_sequences, nd_results)
-
-                if self.config['fast5_output']:
-                    await self.run_in_executor_io(self.fast5_writer.transfer_reads, nd_results)
+                rescounts = await self.run_in_executor_io(self.write_results, nd_results)
+                if rescounts is not None and self.dashboard is not None:
+                    self.dashboard.feed_mapped(rescounts)
 
-                if self.config['nanopolish_output']:
-                    await self.run_in_executor_io(self.npreaddb_writer.write_sequences,
-                                                  nd_results)
-
-                if self.config['minimap2_index']:
-                    rescounts = await self.run_in_executor_io(self.alignment_writer.process,
-                                                              nd_results)
-                    if self.dashboard is not None:
-                        self.dashboard.feed_mapped(rescounts)
-
-                await self.run_in_executor_io(self.seqsummary_writer.write_results, nd_results)
-
-                self.finalsummary_tracker.feed_results(nd_results)
+                self.summary_queue.put_nowait(nd_results)
 
             if (self.error_status_counts['okay'] == 0 and self.running and
                     self.error_status_counts['not_basecalled'] >=
@@ -261,8 +302,12 @@ class ProcessingSession:
                 self.logger.error(stopmsg)
                 self.errx(stopmsg)
 
-        except (CancelledError, BrokenProcessPool):
+        except CancelledError:
             return
+        except BrokenProcessPool as exc:
+            if self.running:
+                self.logger.error('A worker process terminated abruptly', exc_info=exc)
+            return self.errx('ERROR: A worker process terminated abruptly')
         except Exception as exc:
             self.logger.error('Unhandled error during processing reads', exc_info=exc)
             return self.errx('ERROR: Unhandled error ' + str(exc))
@@ -271,68 +316,202 @@ class ProcessingSession:
 
         self.reads_processed += len(nd_results)
         self.reads_queued -= len(nd_results)
+        self.progress_updated.set()
+
+    def tune_batch_size(self, numreads, elapsed):
+        # Fit the batches into the target time window unless the size is fixed
+        # from the command line. The time of a batch is modeled as a fixed cost
+        # plus a cost per read, and they are fitted by the least squares on the
+        # moving averages of the sizes and times.
+        if self.config['batch_chunk_size'] is not None or numreads <= 0:
+            return
 
-    def queue_processing(self, readpath):
-        self.jobstack.append(readpath)
-        self.reads_queued += 1
-        self.reads_found += 1
-        if len(self.jobstack) >= self.config['batch_chunk_size']:
-            self.flush_jobstack()
+        sample = numreads, elapsed, numreads * numreads, numreads * elapsed
+        if self.batch_stats is None:
+            self.batch_stats = list(sample)
+        else:
+            self.batch_stats = [avg + (value - avg) * BATCH_COST_SMOOTHING
+                                for avg, value in zip(self.batch_stats, sample)]
+        mean_n, mean_t, mean_nn, mean_nt = self.batch_stats
+
+        # The costs can be separated only when the recent sizes differ enough.
+        # Otherwise, the last estimates are kept.
+        variance = mean_nn - mean_n * mean_n
+        if variance > (mean_n * BATCH_SIZE_SPREAD_MIN) ** 2:
+            read_cost = (mean_nt - mean_n * mean_t) / variance
+            if read_cost > 0:
+                self.batch_costs = max(0., mean_t - read_cost * mean_n), read_cost
+
+        if self.batch_costs is not None:
+            fixed_cost, read_cost = self.batch_costs
+        else:
+            fixed_cost, read_cost = 0., mean_t / mean_n
+
+        # Grow the batches when the fixed cost alone exceeds the target time.
+        target = max(BATCH_TARGET_TIME, fixed_cost * BATCH_FIXED_COST_RATIO)
+        minsize, maxsize = BATCH_SIZE_RANGE
+        size = int(target / max(read_cost, 1e-6))
+        self.batch_size = min(maxsize, max(minsize, size))
+
+    def write_results(self, results):
+        # Runs in an I/O thread to write the outputs of a batch in one go.
+        if self.config['fastq_output']:
+            self.fastq_writer.write_sequences(results)
+
+        if self.config['fast5_output']:
+            self.fast5_writer.transfer_reads(results)
+
+        if self.config['nanopolish_output']:
+            self.npreaddb_writer.write_sequences(results)
+
+        rescounts = None
+        if self.config['minimap2_index']:
+            rescounts = self.alignment_writer.process(results)
+
+        return rescounts
+
+    async def drain_summaries(self):
+        # Feeds the summaries with the results from many batches at once, up
+        # to about SUMMARY_CHUNK_SIZE reads at a time. This is not cancelled
+        # with the other tasks, but stopped by a None in the queue so that the
+        # last chunk is written before closing the writers.
+        queue = self.summary_queue
+        finished = False
+        try:
+            while not finished:
+                results = await queue.get()
+                if results is None:
+                    break
+                if len(results) < SUMMARY_CHUNK_SIZE:
+                    await asyncio.sleep(SUMMARY_COLLECT_TIME)
+
+                results = list(results)
+                while len(results) < SUMMARY_CHUNK_SIZE and not queue.empty():
+                    more = queue.get_nowait()
+                    if more is None:
+                        finished = True
+                        break
+                    results.extend(more)
+
+                self.finalsummary_tracker.feed_results(results)
+                await self.run_in_executor_io(self.seqsummary_writer.write_results,
+                                              results)
+        except Exception as exc:
+            self.logger.error('Unhandled error during writing summaries', exc_info=exc)
+            return self.errx('ERROR: Unhandled error ' + str(exc))
+
+    def finish_summaries(self):
+        self.summary_queue.put_nowait(None)
+        while not self.summary_task.done():
+            try:
+                self.loop.run_until_complete(self.summary_task)
+            except RuntimeError: # the loop is stopped by a signal
+                pass
+
+    def queue_processing_many(self, readpaths):
+        queued_at = self.loop.time()
+        self.jobstack.extend((readpath, queued_at) for readpath in readpaths)
+        self.reads_queued += len(readpaths)
+        self.reads_found += len(readpaths)
+        self.progress_updated.set()
+        self.jobstack_updated.set()
 
     def flush_jobstack(self):
-        if self.running and self.jobstack:
+        # Let the reads queued up to now go in batches smaller than the size
+        self.reads_to_flush = len(self.jobstack)
+        self.jobstack_updated.set()
+
+    async def next_batch(self):
+        jobstack = self.jobstack
+        while True:
+            # The size is taken at the time of cutting so that the batches
+            # follow the latest tuning from the finished ones.
+            size = self.batch_size
+            if len(jobstack) >= size or (jobstack and self.reads_to_flush > 0):
+                size = min(size, len(jobstack))
+
+                # Wait until the input files become ready if needed. The delay
+                # counts from the time when the reads entered the job stack.
+                delay = (jobstack[size - 1][1] + self.config['analysis_start_delay']
+                         - self.loop.time())
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                    continue
+
+                self.reads_to_flush = max(0, self.reads_to_flush - size)
+                return [jobstack.popleft()[0] for _ in range(size)]
+
+            self.jobstack_updated.clear()
+            await self.jobstack_updated.wait()
+
+    async def dispatch_batches(self):
+        # Batches are cut only when a slot is available to run them. This
+        # bounds the batches in flight and lets the tuned size take effect
+        # for the reads waiting in the stack.
+        while self.running:
+            try:
+                await self.batch_slots.acquire()
+                try:
+                    jobs = await self.next_batch()
+                except:
+                    self.batch_slots.release()
+                    raise
+            except CancelledError:
+                break
+
             batch_id = self.next_batch_id
             self.next_batch_id += 1
 
-            # Remove files already processed successfully. The same file can be
-            # fed into the stack while making transition from the existing
-            # files to newly updated files from the live monitoring.
-            reads_to_submit = [
-                readpath for readpath in self.jobstack
-                if readpath not in self.reads_done]
-            num_canceled = len(self.jobstack) - len(reads_to_submit)
+            # Remove reads already submitted to another batch or processed
+            # successfully. The same file can be fed into the stack while making
+            # transition from the existing files to newly updated files from
+            # the live monitoring. The reads are reserved for this batch here to
+            # skip the events arriving while the batch is running.
+            reads_to_submit = []
+            for readpath in jobs:
+                if readpath not in self.reads_submitted:
+                    self.reads_submitted[readpath] = batch_id
+                    reads_to_submit.append(readpath)
+            num_canceled = len(jobs) - len(reads_to_submit)
             if num_canceled:
                 self.reads_queued -= num_canceled
                 self.reads_found -= num_canceled
-            del self.jobstack[:]
+                self.progress_updated.set()
 
             if reads_to_submit:
-                work = self.run_process_batch(batch_id, reads_to_submit)
-                self.loop.create_task(work)
-
-    async def scan_dir_recursive(self, topdir, dirname=''):
-        if not self.running:
-            return
-
-        is_topdir = (dirname == '')
+                task = self.spawn(self.run_process_batch(batch_id, reads_to_submit))
+                task.add_done_callback(lambda _: self.batch_slots.release())
+            else:
+                self.batch_slots.release()
 
-        try:
-            errormsg = None
-            dirs, files = await self.run_in_executor_mon(
-                scan_dir_recursive_worker, os.path.join(topdir, dirname))
-        except CancelledError as exc:
-            if is_topdir: return
-            else: raise exc
-        except Exception as exc:
-            errormsg = str(exc)
+    async def scan_dir_recursive(self, topdir):
+        # Scan all directories in the same depth concurrently to overlap the
+        # latencies of slow filesystems.
+        level = ['']
+        while level and self.running:
+            scanjobs = [self.run_in_executor_scan(scan_dir_worker, topdir, dirname)
+                        for dirname in level]
+            level = []
 
-        if errormsg is not None:
-            return self.errx('ERROR: ' + str(errormsg))
+            try:
+                errormsg = None
+                for scanjob in asyncio.as_completed(scanjobs):
+                    dirs, files = await scanjob
+                    level.extend(dirs)
+
+                    readpaths = []
+                    for filepath in files:
+                        readpaths.extend(get_read_ids(filepath, topdir))
+                    self.queue_processing_many(readpaths)
+            except CancelledError:
+                return
+            except Exception as exc:
+                errormsg = str(exc)
 
-        for filename in files:
-            filepath = os.path.join(dirname, filename)
-            for readpath in get_read_ids(filepath, topdir):
-                self.queue_processing(readpath)
+            if errormsg is not None:
+                return self.errx('ERROR: ' + str(errormsg))
 
-        try:
-            for subdir in dirs:
-                subdirpath = os.path.join(dirname, subdir)
-                await self.scan_dir_recursive(topdir, subdirpath)
-        except CancelledError as exc:
-            if is_topdir: return
-            else: raise exc
-
-        if is_topdir:
+        if self.running:
             self.flush_jobstack()
             self.scan_finished = True
 
@@ -341,28 +520,30 @@ class ProcessingSession:
         from inotify.constants import IN_CLOSE_WRITE, IN_MOVED_TO
 
         watch_flags = IN_CLOSE_WRITE | IN_MOVED_TO
-        topdir = os.path.abspath(topdir + '/') + '/' # add / for commonprefix
+        topdir = os.path.abspath(topdir + '/') + '/' # add / for prefix matching
         is_fast5_to_analyze = lambda fn: fn[:1] != '.' and fn.lower().endswith(suffix)
         try:
             evgen = InotifyTree(topdir, mask=watch_flags).event_gen()
             while True:
-                event = await self.run_in_executor_mon(next, evgen)
-                if event is None:
-                    continue
+                events = await self.run_in_executor_mon(collect_inotify_events, evgen)
 
-                header, type_names, path, filename = event
-                if 'IN_ISDIR' in type_names:
-                    continue
-                if header.mask & watch_flags and is_fast5_to_analyze(filename):
-                    common = os.path.commonprefix([topdir, path])
-                    if common != topdir:
-                        errprint("ERROR: Change of {} detected, which is outside "
-                                 "{}.".format(path, topdir))
+                readpaths = []
+                for header, type_names, path, filename in events:
+                    if 'IN_ISDIR' in type_names:
                         continue
-                    relpath = os.path.join(path[len(common):], filename)
-                    for readpath in get_read_ids(relpath, topdir):
-                        if readpath not in self.reads_done:
-                            self.queue_processing(readpath)
+                    if header.mask & watch_flags and is_fast5_to_analyze(filename):
+                        if not path.startswith(topdir):
+                            errprint("ERROR: Change of {} detected, which is outside "
+                                     "{}.".format(path, topdir))
+                            continue
+                        subdir = path[len(topdir):]
+                        relpath = subdir + '/' + filename if subdir else filename
+                        readpaths.extend(
+                            readpath for readpath in get_read_ids(relpath, topdir)
+                            if readpath not in self.reads_submitted)
+
+                if readpaths:
+                    self.queue_processing_many(readpaths)
 
         except CancelledError:
             pass
@@ -377,6 +558,26 @@ class ProcessingSession:
             if self.scan_finished and self.reads_queued <= 0:
                 break
 
+    async def flush_logs_periodically(self):
+        # The log records are buffered in memory. Write them out regularly so
+        # that they survive an abnormal termination of a long live session.
+        while self.running:
+            for handler in self.logger.handlers:
+                handler.flush()
+
+            try:
+                await asyncio.sleep(LOG_FLUSH_INTERVAL)
+            except CancelledError:
+                break
+
+    async def wait_progress_update(self, timeout=PROGRESS_REFRESH_TIMEOUT):
+        # Wake up on changes of the counters, or periodically for the timers
+        try:
+            await asyncio.wait_for(self.progress_updated.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self.progress_updated.clear()
+
     async def show_progresses_offline(self):
         from progressbar import ProgressBar, widgets
 
@@ -409,7 +610,7 @@ class ProcessingSession:
                 self.pbar.update(self.reads_processed)
 
             try:
-                await asyncio.sleep(0.3)
+                await self.wait_progress_update()
             except CancelledError:
                 break
 
@@ -444,14 +645,14 @@ class ProcessingSession:
                 prev_found = self.reads_found
 
             try:
-                await asyncio.sleep(0.3)
+                await self.wait_progress_update()
             except CancelledError:
                 break
 
     async def force_flushing_stalled_queue(self):
         prev_count = -1
-        heartbeat = max(10, int(self.config['analysis_start_delay'] // 2))
         stall_counter = 0; stall_trigger = 2
+        heartbeat = self.config['max_queue_time'] / stall_trigger
 
         while self.running:
             try:
@@ -487,22 +688,26 @@ class ProcessingSession:
         return view
 
     def terminate_executors(self):
-        force_terminate_executor(self.executor_compute)
+        # The batches already running are left to finish so that the workers
+        # can close their dump files on exit.
+        self.executor_compute.shutdown(wait=False, cancel_futures=True)
 
     def finalize_results(self):
+        # The workers close their part files at exit. Wait until they are gone
+        # before the parts are linked into the inventories.
+        self.executor_compute.shutdown(wait=True)
+
         if self.config['dump_adapter_signals']:
             self.show_message("==> Creating an inventory for adapter signal dumps")
-            adapter_dump_prefix = os.path.join(self.config['outputdir'], 'adapter-dumps')
             create_adapter_dumps_inventory(
-                os.path.join(adapter_dump_prefix, 'inventory.h5'),
-                os.path.join(adapter_dump_prefix, 'part-*.h5'))
+                os.path.join(self.adapter_dump_prefix, 'inventory.h5'),
+                os.path.join(self.adapter_dump_prefix, 'part-*.h5'))
 
         if self.config['dump_basecalls']:
             self.show_message("==> Creating an inventory for basecalled events")
-            events_prefix = os.path.join(self.config['outputdir'], 'events')
             create_events_inventory(
-                os.path.join(events_prefix, 'inventory.h5'),
-                os.path.join(events_prefix, 'part-*.h5'))
+                os.path.join(self.events_prefix, 'inventory.h5'),
+                os.path.join(self.events_prefix, 'part-*.h5'))
 
     @classmethod
     def run(kls, config, logging):
@@ -511,10 +716,12 @@ class ProcessingSession:
 
             if config['live']:
                 # Start monitoring stalled queue
-                mon_task = sess.loop.create_task(sess.force_flushing_stalled_queue())
+                mon_task = sess.spawn(sess.force_flushing_stalled_queue())
             else:
                 # Start monitoring finished processing
-                mon_task = sess.loop.create_task(sess.wait_until_finish())
+                mon_task = sess.spawn(sess.wait_until_finish())
+
+            sess.spawn(sess.flush_logs_periodically())
 
             # Start a progress updater for the user
             if config['quiet']:
@@ -522,18 +729,24 @@ class ProcessingSession:
             elif config['dashboard']:
                 sess.dashboard = sess.start_dashboard()
             elif config['live']:
-                sess.loop.create_task(sess.show_progresses_live())
+                sess.spawn(sess.show_progresses_live())
             else:
-                sess.loop.create_task(sess.show_progresses_offline())
+                sess.spawn(sess.show_progresses_offline())
+
+            # Start the writer of the summaries
+            sess.summary_task = sess.loop.create_task(sess.drain_summaries())
+
+            # Start cutting the batches from the job stack
+            sess.spawn(sess.dispatch_batches())
 
             # Start the directory scanner
             scanjob = sess.scan_dir_recursive(config['inputdir'])
-            sess.loop.create_task(scanjob)
+            sess.spawn(scanjob)
 
             # Start the directory change watcher in the live mode
             if config['live']:
                 livewatcher = sess.live_watch_inputs(config['inputdir'])
-                sess.loop.create_task(livewatcher)
+                sess.spawn(livewatcher)
 
             try:
                 sess.loop.run_until_complete(mon_task)
@@ -555,7 +768,7 @@ class ProcessingSession:
             if sess.dashboard is not None:
                 sess.dashboard.stop()
 
-            for task in asyncio.Task.all_tasks():
+            for task in list(sess.tasks):
                 if not (task.done() or task.cancelled()):
                     try:
                         try: task.cancel()
@@ -570,6 +783,8 @@ class ProcessingSession:
                         else:
                             errprint('\nERROR: ' + str(exc))
 
+            sess.finish_summaries()
+
             if not config['quiet'] and sess.scan_finished:
                 if sess.pbar is not None:
                     sess.pbar.finish()
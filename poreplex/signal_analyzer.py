@@ -23,6 +23,7 @@
 from weakref import proxy
 from itertools import groupby
 import multiprocessing as mp
+from multiprocessing.util import Finalize
 import numpy as np
 import pandas as pd
 from hashlib import sha1
@@ -35,27 +36,41 @@ from scipy.signal import medfilt
 from .worker_persistence import WorkerPersistenceStorage
 from .utils import union_intervals
 
-__all__ = ['SignalAnalyzer', 'SignalAnalysis', 'process_batch']
+__all__ = ['SignalAnalyzer', 'SignalAnalysis', 'init_worker', 'process_batch']
 
 
 class SignalAnalysisError(Exception):
     pass
 
 
+# Per-process states of the worker processes
+worker_config = worker_analyzer = None
+
+
 # This function must be picklable.
-def process_batch(batchid, reads, config):
+def init_worker(config):
+    global worker_config
+    worker_config = config
+
+
+# This function must be picklable. Unhandled exceptions are passed to the
+# caller along with the traceback from the worker by the executor.
+def process_batch(batchid, reads):
+    global worker_analyzer
     try:
-        with SignalAnalyzer(config, batchid) as analyzer:
+        if worker_analyzer is None:
+            worker_analyzer = SignalAnalyzer(worker_config)
+            Finalize(worker_analyzer, worker_analyzer.close, exitpriority=10)
+        with worker_analyzer.begin_batch(batchid) as analyzer:
             return analyzer.process(reads)
     except Exception as exc:
-        exc_type, exc_obj, exc_tb = sys.exc_info()
-        filename = os.path.split(exc_tb.tb_frame.f_code.co_filename)[-1]
-        errorf = StringIO()
-        traceback.print_exc(file=errorf)
-
-        return (-1, '[{filename}:{lineno}] Unhandled exception {name}: {msg}'.format(
-                        filename=filename, lineno=exc_tb.tb_lineno,
-                        name=type(exc).__name__, msg=str(exc)), errorf.getvalue())
+        # Exceptions from the extension modules may not be unpickled in the
+        # parent. Raise a plain error instead, which keeps the original in the
+        # chained traceback sent to the parent.
+        filename, lineno = traceback.extract_tb(exc.__traceback__)[-1][:2]
+        raise RuntimeError('[{filename}:{lineno}] Unhandled exception {name}: {msg}'.format(
+                filename=os.path.split(filename)[-1], lineno=lineno,
+                name=type(exc).__name__, msg=str(exc)))
 
 
 class SignalAnalyzer:
@@ -68,29 +83,46 @@ class SignalAnalyzer:
         '<i4', '<u8', '<u8', '<f8']
     EVENT_DUMP_FIELDS = list(zip(_EVENT_DUMP_FIELD_NAMES, _EVENT_DUMP_FIELD_DTYPES))
 
-    def __init__(self, config, batchid):
-        WorkerPersistenceStorage(config).retrieve_objects(self)
-
+    def __init__(self, config):
         self.config = config
         self.inputdir = config['inputdir']
         self.outputdir = config['outputdir']
         self.workerid = sha1(mp.current_process().name.encode()).hexdigest()[:16]
+        self.batchid = self.formatted_batchid = None
+        self.adapter_dump_file = self.adapter_dump_group = None
+        self.basecall_dump_file = self.basecall_dump_group = None
+        self.adapter_dump_list = []
+
+    def begin_batch(self, batchid):
+        # Retrieving the persistent objects also clears the per-batch states
+        # of the loader and the demultiplexer.
+        WorkerPersistenceStorage(self.config).retrieve_objects(self)
+
         self.batchid = batchid
         self.formatted_batchid = format(batchid, '08d')
         self.open_dumps()
+        return self
+
+    def end_batch(self):
+        if self.adapter_dump_file is not None:
+            catgrp = self.adapter_dump_file.require_group('catalog/adapter')
+            encodedarray = np.array(self.adapter_dump_list,
+                dtype=[('read_id', 'S36'), ('start', 'i8'), ('end', 'i8')])
+            catgrp.create_dataset(self.formatted_batchid, shape=encodedarray.shape,
+                                  data=encodedarray)
+            self.adapter_dump_list = []
+            self.adapter_dump_file.flush()
+
+        if self.basecall_dump_file is not None:
+            self.basecall_dump_file.flush()
 
     def process(self, reads):
-        inputdir = self.config['inputdir']
         results, loaded = [], []
 
         # Initialize processors and preload signals from fast5
         nextprocs = []
         prepare_loading = self.loader.prepare_loading
         for f5file, read_id in reads:
-            if not os.path.exists(os.path.join(inputdir, f5file)):
-                results.append({'filename': f5file, 'status': 'disappeared'})
-                continue
-
             try:
                 npread = prepare_loading(f5file, read_id)
                 if npread.is_stopped():
@@ -99,6 +131,10 @@ class SignalAnalyzer:
                     siganal = SignalAnalysis(npread, self)
                     nextprocs.append(siganal)
                     loaded.append(npread)
+            except FileNotFoundError:
+                # Checked on opening the file to save a stat call for each read
+                results.append({'filename': f5file, 'read_id': read_id,
+                                'status': 'disappeared'})
             except Exception as exc:
                 error = self.pack_unhandled_exception(f5file, read_id, exc, sys.exc_info())
                 results.append(error)
@@ -153,28 +189,26 @@ class SignalAnalyzer:
         }
 
     def open_dumps(self):
-        self.EVENT_DUMP_FIELDS[4] = (self.EVENT_DUMP_FIELDS[4][0], 'S{}'.format(self.kmersize))
-
+        # The part files stay open during the whole lifetime of the worker.
         if self.config['dump_adapter_signals']:
-            self.adapter_dump_file, self.adapter_dump_group = \
-                self.open_dump_file('adapter-dumps', 'adapter')
+            if self.adapter_dump_file is None:
+                self.adapter_dump_file = self.open_dump_file('adapter-dumps')
+            self.adapter_dump_group = self.adapter_dump_file.require_group(
+                'adapter/' + self.formatted_batchid)
             self.adapter_dump_list = []
-        else:
-            self.adapter_dump_file = self.adapter_dump_group = None
 
         if self.config['dump_basecalls']:
-            self.basecall_dump_file, self.basecall_dump_group = \
-                self.open_dump_file('events', 'basecalled_events')
-        else:
-            self.basecall_dump_file = self.basecall_dump_group = None
-
-    def open_dump_file(self, subdir, parentgroup):
+            if self.basecall_dump_file is None:
+                self.EVENT_DUMP_FIELDS[4] = (self.EVENT_DUMP_FIELDS[4][0],
+                                             'S{}'.format(self.kmersize))
+                self.basecall_dump_file = self.open_dump_file('events')
+            self.basecall_dump_group = self.basecall_dump_file.require_group(
+                'basecalled_events/' + self.formatted_batchid)
+
+    def open_dump_file(self, subdir):
         h5filename = os.path.join(self.outputdir, subdir,
                                   'part-' + self.workerid + '.h5')
-        h5 = h5py.File(h5filename, 'a')
-        h5group = h5.require_group(parentgroup +
-                                   '/' + self.formatted_batchid)
-        return h5, h5group
+        return h5py.File(h5filename, 'a')
 
     def push_adapter_signal_catalog(self, read_id, adapter_start, adapter_end):
         self.adapter_dump_list.append((read_id, adapter_start, adapter_end))
@@ -196,19 +230,16 @@ class SignalAnalyzer:
         return self
 
     def __exit__(self, *exc):
-        self.close()
+        self.end_batch()
 
     def close(self):
         if self.adapter_dump_file is not None:
-            catgrp = self.adapter_dump_file.require_group('catalog/adapter')
-            encodedarray = np.array(self.adapter_dump_list,
-                dtype=[('read_id', 'S36'), ('start', 'i8'), ('end', 'i8')])
-            catgrp.create_dataset(self.formatted_batchid, shape=encodedarray.shape,
-                                  data=encodedarray)
             self.adapter_dump_file.close()
+            self.adapter_dump_file = None
 
         if self.basecall_dump_file is not None:
             self.basecall_dump_file.close()
+            self.basecall_dump_file = None
 
 
 class SignalAnalysis:
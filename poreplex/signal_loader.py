@@ -24,6 +24,7 @@
 import h5py
 import numpy as np
 import pandas as pd
+import errno
 import os
 from scipy.stats import norm
 from functools import partial
@@ -193,13 +194,26 @@ class NanoporeRead:
             rep['barcode_score'] = self.barcode_quality
 
         if self.polya is not None:
-            rep['polya'] = self.polya
+            # The spikes are needed only for the dumps written by the worker.
+            rep['polya'] = {k: v for k, v in self.polya.items() if k != 'spikes'}
 
         return rep
 
     def load(self):
         try:
             fast5 = Fast5Reader(self.fullpath, self.read_id)
+        except FileNotFoundError: # reported as disappeared by the caller
+            raise
+        except OSError as exc:
+            # h5py 2.x raises a plain OSError for a missing file. The file is
+            # checked only on this failure path to save a stat call per read.
+            if not os.path.exists(self.fullpath):
+                raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT),
+                                        self.fullpath) from exc
+            import traceback
+            traceback.print_exc()
+            self.set_status('irregular_fast5', stop=True)
+            return
         except:
             import traceback
             traceback.print_exc()
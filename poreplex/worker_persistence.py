@@ -35,6 +35,7 @@ __all__ = ['WorkerPersistenceStorage']
 class WorkerPersistenceStorage:
 
     STORAGE_NAME = '__poreplex_persistence'
+    PRELOAD_NAME = '__poreplex_preloaded'
     MODCACHE_SPACE = sys.modules
     VARIABLES = [
         'segmodel', 'unsplitmodel', 'kmermodel', 'kmersize', 'loader',
@@ -57,13 +58,29 @@ class WorkerPersistenceStorage:
             if varname in storage:
                 storage[varname].clear()
 
-    def init_persistence_objects(self, config):
+    def preload_shared_objects(self):
+        # Loads the models that are safe to be inherited by forked workers.
+        # The keras and albacore objects start threads, so they are still
+        # created in the workers.
+        fakespec = imputil.spec_from_file_location('spam', 'egg.py')
+        premod = imputil.module_from_spec(fakespec)
+        premod.storage = self.load_shared_objects(self.config)
+        self.MODCACHE_SPACE[self.PRELOAD_NAME] = premod
+
+    def load_shared_objects(self, config):
         storage = {
             'segmodel': load_segmentation_model(config['segmentation_model']),
             'unsplitmodel': load_segmentation_model(config['unsplit_read_detection_model']),
             'kmermodel': pd.read_csv(config['kmer_model'], header=0, index_col=0, sep='\t'),
         }
         storage['kmersize'] = len(storage['kmermodel'].index[0])
+        return storage
+
+    def init_persistence_objects(self, config):
+        if self.PRELOAD_NAME in self.MODCACHE_SPACE:
+            storage = dict(self.MODCACHE_SPACE[self.PRELOAD_NAME].storage)
+        else:
+            storage = self.load_shared_objects(config)
 
         if config['barcoding']:
             from .barcoding import BarcodeDemultiplexer
@@ -48,6 +48,7 @@ setup(
     long_description=open('README.md').read(),
     long_description_content_type='text/markdown',
     include_package_data=True,
+    python_requires='>=3.9',
     keywords=[
         'nanopore',
         'direct RNA sequencing',
@@ -20,6 +20,97 @@
 # THE SOFTWARE.
 #
 
+import io
+import os
+import pickle
+import stat
+import pytest
+from poreplex import commandline
+
 def test_dummy():
     pass
 
+@pytest.fixture
+def user_cache(tmp_path, monkeypatch):
+    cachedir = tmp_path / 'cache'
+    monkeypatch.setenv('XDG_CACHE_HOME', str(cachedir))
+    return cachedir / 'poreplex'
+
+def test_load_yaml_cached_user_config(tmp_path, user_cache):
+    config_path = tmp_path / 'custom.cfg'
+    config_path.write_text('value: 1\n')
+
+    assert commandline.load_yaml_cached(str(config_path)) == {'value': 1}
+    assert not os.path.exists(str(config_path) + '.pkl')
+    assert len(list(user_cache.glob('config-*.pkl'))) == 1
+
+def test_load_yaml_cached_uses_valid_cache(tmp_path, user_cache):
+    config_path = tmp_path / 'custom.cfg'
+    config_path.write_text('value: 1\n')
+    commandline.load_yaml_cached(str(config_path))
+
+    cache_path, = user_cache.glob('config-*.pkl')
+    with open(str(cache_path), 'rb') as f:
+        stamp, config = pickle.load(f)
+    with open(str(cache_path), 'wb') as f:
+        pickle.dump((stamp, {'value': 'cached'}), f)
+
+    assert commandline.load_yaml_cached(str(config_path)) == {'value': 'cached'}
+
+def test_load_yaml_cached_older_source(tmp_path, user_cache):
+    config_path = tmp_path / 'custom.cfg'
+    config_path.write_text('value: 1\n')
+    st = os.stat(str(config_path))
+    commandline.load_yaml_cached(str(config_path))
+
+    # A restored source of the same size with an older time is not in the cache
+    config_path.write_text('value: 2\n')
+    os.utime(str(config_path), ns=(st.st_atime_ns, st.st_mtime_ns - 10**9))
+
+    assert commandline.load_yaml_cached(str(config_path)) == {'value': 2}
+
+def test_clear_directory_keeps_directory(tmp_path):
+    outputdir = tmp_path / 'output'
+    outputdir.mkdir()
+    os.chmod(str(outputdir), 0o750)
+    (outputdir / 'fastq').mkdir()
+    (outputdir / 'fastq' / 'pass.fastq.gz').write_bytes(b'data')
+    (outputdir / 'poreplex.log').write_text('log\n')
+    os.symlink(str(tmp_path), str(outputdir / 'link'))
+
+    commandline.clear_directory(str(outputdir))
+
+    assert stat.S_IMODE(os.stat(str(outputdir)).st_mode) == 0o750
+    assert [name for name in os.listdir(str(outputdir))
+            if not name.startswith('.stale.')] == []
+    assert os.path.isdir(str(tmp_path))
+
+def test_show_configuration_output():
+    config = {
+        'inputdir': 'fast5', 'outputdir': 'output', 'live': True,
+        'analysis_start_delay': 60, 'parallel': 4, 'preset_name': 'rna-r941',
+        'albacore_onthefly': False, 'trim_adapter': True,
+        'filter_unsplit_reads': False, 'barcoding': True, 'minimap2_index': None,
+        'fastq_output': True, 'fast5_output': False, 'dump_basecalls': False,
+        'dump_adapter_signals': True,
+    }
+    output = io.StringIO()
+    commandline.show_configuration(config, outputs=[output])
+
+    assert output.getvalue() == (
+        "== Analysis settings ======================================\n"
+        " * Input:\tfast5\t(live, 60 sec delay)\n"
+        " * Output:\toutput\n"
+        " * Processes:\t4\n"
+        " * Presets:\trna-r941\n"
+        " * Basecall on-the-fly:\t\tNo (use previous analyses)\n"
+        " * Trim 3' adapter:\t\tYes\n"
+        " * Filter concatenated read:\tNo\n"
+        " * Separate by barcode:\t\tYes\n"
+        " * Real-time alignment:\t\tNo\n"
+        " * FASTQ in output:\t\tYes\n"
+        " * FAST5 in output:\t\tNo\n"
+        " * Basecall table in output:\tNo\n"
+        " * Dump adapter signals for training:\tYes\n"
+        "===========================================================\n"
+        "\n")
@@ -0,0 +1,69 @@
+#
+# Copyright (c) 2018 Institute for Basic Science
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+from types import SimpleNamespace
+import pytest
+
+pipeline = pytest.importorskip('poreplex.pipeline')
+
+
+def make_session(batch_chunk_size=None):
+    return SimpleNamespace(config={'batch_chunk_size': batch_chunk_size},
+                           batch_size=pipeline.BATCH_SIZE_INITIAL,
+                           batch_stats=None, batch_costs=None)
+
+def feed_batches(sess, sizes, fixed_cost, read_cost):
+    for size in sizes:
+        pipeline.ProcessingSession.tune_batch_size(
+            sess, size, fixed_cost + read_cost * size)
+
+def test_tune_batch_size_separates_costs():
+    sess = make_session()
+    feed_batches(sess, [50, 150] * 20, 0.1, 0.004)
+
+    fixed_cost, read_cost = sess.batch_costs
+    assert fixed_cost == pytest.approx(0.1)
+    assert read_cost == pytest.approx(0.004)
+    assert sess.batch_size == pytest.approx(pipeline.BATCH_TARGET_TIME / 0.004, abs=1)
+
+def test_tune_batch_size_large_fixed_cost():
+    sess = make_session()
+    feed_batches(sess, [40, 60] * 20, 0.5, 0.02)
+
+    # The target time grows with the fixed cost
+    assert sess.batch_size == pytest.approx(
+        0.5 * pipeline.BATCH_FIXED_COST_RATIO / 0.02, abs=1)
+
+def test_tune_batch_size_same_sizes():
+    sess = make_session()
+    feed_batches(sess, [100] * 5, 0.1, 0.004)
+
+    assert sess.batch_costs is None
+    assert sess.batch_size == pytest.approx(pipeline.BATCH_TARGET_TIME / 0.005, abs=1)
+
+def test_tune_batch_size_fixed_size():
+    sess = make_session(batch_chunk_size=32)
+    sess.batch_size = 32
+    feed_batches(sess, [50, 150] * 5, 0.1, 0.004)
+
+    assert sess.batch_size == 32
+    assert sess.batch_stats is None